@@ -1,53 +1,34 @@
+import asyncio
+import functools
+import hashlib
 import json
 import os
-from openai import OpenAI
-from typing import List, Dict, Tuple
+import random
+import re
+import time
+from dataclasses import dataclass, field
+import httpx
+import orjson
+from openai import AsyncOpenAI, RateLimitError
+from prompt_toolkit import PromptSession
+from pathlib import Path
+from typing import Callable, Final, List, Literal, Dict, Optional, Tuple
 from datetime import datetime
 from dotenv import load_dotenv
 
-class PolicyRequirementsEngineer:
-    def __init__(self, api_key: str = None):
-        # Load environment variables from .env file
-        load_dotenv()
-        
-        # Use provided api_key or get from environment variable
-        self.api_key = api_key or os.getenv('OPENAI_API_KEY')
-        if not self.api_key:
-            raise ValueError("OpenAI API key not found. Please set OPENAI_API_KEY environment variable or provide it as an argument.")
-        
-        self.client = OpenAI(api_key=self.api_key)
-        
-    def _clean_response_text(self, text: str) -> str:
-        """Remove markdown code block formatting from response text"""
-        text = text.strip()
-        
-        # Remove opening markdown code block
-        if text.startswith('```json'):
-            text = text[7:]  # Remove '```json'
-        elif text.startswith('```'):
-            text = text[3:]   # Remove '```'
-        
-        # Remove closing markdown code block
-        if text.endswith('```'):
-            text = text[:-3]  # Remove closing '```'
-        
-        return text.strip()
-        
-    def nl_to_checklist_prompt(self, nl_requirement: str) -> str:
-        """Generate prompt for converting NL to checklist DSL"""
-        return f"""You are an expert in AWS IAM policy requirements analysis. Convert the following natural language requirement into a structured policy requirements checklist.
-
-The checklist must be in the exact JSON format specified below. Analyze the requirement carefully and identify:
-1. Whether all required elements are specified
-2. Any ambiguities that could lead to multiple interpretations
-3. Missing information that prevents unique policy generation
-
-Natural Language Requirement:
-"{nl_requirement}"
+MODEL = "o4-mini"
+REASONING = {"effort": "high"}
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "policy_re"
+MAX_RATE_LIMIT_RETRIES = 6
+KEEPALIVE_EXPIRY = 30.0
+# Ceiling on concurrent in-flight requests for each HTTP backend
+MAX_CONNECTIONS = {"httpx": 100, "aiohttp": 256}
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Routes requests that share the prompt scaffolds below to the same prefix cache
+PROMPT_CACHE_KEY = "policy_re_v1"
 
-Output Format:
-{{
-  "checklistMetadata": {{
+_CHECKLIST_SCHEMA: Final[str] = """{
+  "checklistMetadata": {
     "version": "1.0",
     "status": "INCOMPLETE|AMBIGUOUS|COMPLETE",
     "totalRequirements": <number>,
@@ -55,38 +36,38 @@ Output Format:
     "ambiguityLevel": "HIGH|MEDIUM|LOW|NONE",
     "validationErrors": [],
     "validationWarnings": []
-  }},
-  "policyIntent": {{
+  },
+  "policyIntent": {
     "originalNL": "<original text>",
     "parsedIntent": "<summary>",
     "scope": "SINGLE_RULE|MULTI_RULE|POLICY_SET"
-  }},
+  },
   "requirements": [
-    {{
+    {
       "ruleId": "RULE_001",
       "status": "RESOLVED|AMBIGUOUS|INCOMPLETE",
-      "effect": {{
+      "effect": {
         "value": "ALLOW|DENY|UNSPECIFIED",
         "confidence": "EXPLICIT|INFERRED|MISSING",
         "nlSource": "<text from NL>"
-      }},
-      "principal": {{
+      },
+      "principal": {
         "type": "SPECIFIC_ARN|ROLE|GROUP|ATTACHED_IDENTITY|UNSPECIFIED",
         "value": "<value or UNSPECIFIED>",
         "confidence": "EXPLICIT|INFERRED|AMBIGUOUS|MISSING",
         "ambiguityReason": "<reason if ambiguous>",
         "resolutionRequired": ["<suggestions>"],
         "nlSource": "<text from NL>"
-      }},
-      "actions": {{
+      },
+      "actions": {
         "service": "<service>|UNSPECIFIED",
         "operations": ["<operations>"],
         "pattern": "EXPLICIT_LIST|WILDCARD|PREFIX_PATTERN|UNSPECIFIED",
         "confidence": "EXPLICIT|INFERRED|AMBIGUOUS|MISSING",
         "ambiguityReason": "<reason if ambiguous>",
         "nlSource": "<text from NL>"
-      }},
-      "resources": {{
+      },
+      "resources": {
         "type": "SPECIFIC_ARN|PATTERN|WILDCARD|UNSPECIFIED",
         "values": ["<values>"],
         "variables": [],
@@ -94,30 +75,53 @@ Output Format:
         "ambiguityReason": "<reason if ambiguous>",
         "resolutionRequired": ["<suggestions>"],
         "nlSource": "<text from NL>"
-      }},
-      "conditions": {{
+      },
+      "conditions": {
         "present": true|false,
         "expressions": [],
         "nlSource": "<text from NL>"
-      }}
-    }}
+      }
+    }
   ],
-  "resolutionGuidance": {{
+  "resolutionGuidance": {
     "missingRequired": [],
     "ambiguousElements": [],
     "potentialPolicies": <number>,
     "reason": "<explanation>"
-  }}
-}}
+  }
+}"""
+
+# The checklist prompt is the fixed head, the NL requirement, then the tail. The head
+# is rendered once here; keeping it stable also makes it a cacheable prompt prefix
+_CHECKLIST_PROMPT_HEAD: Final[str] = """You are an expert in AWS IAM policy requirements analysis. Convert the natural language requirement given at the end of this prompt into a structured policy requirements checklist.
+
+The checklist must be in the exact JSON format specified below. Analyze the requirement carefully and identify:
+1. Whether all required elements are specified
+2. Any ambiguities that could lead to multiple interpretations
+3. Missing information that prevents unique policy generation
+
+Output Format:
+""" + _CHECKLIST_SCHEMA + """
 
 Be extremely careful to identify ALL ambiguities. If status is "COMPLETE", there should be exactly ONE possible policy interpretation.
 
-Output only valid JSON."""
+Output only valid JSON.
 
-    def checklist_to_policy_prompt(self, checklist: Dict) -> str:
-        """Generate prompt for converting checklist to SPT policy"""
-        return f"""You are an expert in AWS IAM policy generation using SimplePolicyTalk (SPT) DSL. 
-Generate an SPT policy based on the following requirements checklist.
+Natural Language Requirement:
+\""""
+_CHECKLIST_PROMPT_TAIL: Final[str] = '"'
+
+_SPT_SYNTAX: Final[str] = """SPT Syntax Reminder:
+- Format: EFFECT Principal "<principal>" Action "<action>" On "<resource>" [When "<condition>"];
+- Effects: ALLOW | DENY
+- Principal examples: "principal_id:ATTACHED_IDENTITY", "aws_principal_arn:arn:aws:iam::123:role/Name"
+- Action examples: "service:s3 action:GetObject", "service:ec2 actions:[\\"StartInstances\\", \\"StopInstances\\"]"
+- Resource examples: "resource_pattern:*", "resource_arn:arn:aws:s3:::bucket/*\""""
+
+# The policy prompt is this fixed head followed by the checklist JSON; stable
+# instructions come first so repeated calls share a cacheable prompt prefix
+_POLICY_PROMPT_HEAD: Final[str] = """You are an expert in AWS IAM policy generation using SimplePolicyTalk (SPT) DSL. 
+Generate an SPT policy based on the requirements checklist given at the end of this prompt.
 
 CRITICAL INSTRUCTIONS:
 1. You MUST generate a policy that EXACTLY matches the requirements in the checklist
@@ -125,76 +129,427 @@ CRITICAL INSTRUCTIONS:
 3. If the checklist has ambiguities, make the SAME interpretation choices consistently
 4. Use only the information provided in the checklist - do not add or infer additional requirements
 
+""" + _SPT_SYNTAX + """
+
+Generate ONLY the SPT policy statement(s). Each statement must end with a semicolon.
+Output format: Just the SPT statement(s), no explanations or JSON.
+
 Requirements Checklist:
-{json.dumps(checklist, indent=2)}
+"""
 
-SPT Syntax Reminder:
-- Format: EFFECT Principal "<principal>" Action "<action>" On "<resource>" [When "<condition>"];
-- Effects: ALLOW | DENY
-- Principal examples: "principal_id:ATTACHED_IDENTITY", "aws_principal_arn:arn:aws:iam::123:role/Name"
-- Action examples: "service:s3 action:GetObject", "service:ec2 actions:[\\"StartInstances\\", \\"StopInstances\\"]"
-- Resource examples: "resource_pattern:*", "resource_arn:arn:aws:s3:::bucket/*"
+@functools.lru_cache(maxsize=512)
+def nl_to_checklist_prompt(nl_requirement: str) -> str:
+    """Generate prompt for converting NL to checklist DSL"""
+    return f'{_CHECKLIST_PROMPT_HEAD}{nl_requirement}{_CHECKLIST_PROMPT_TAIL}'
 
-Generate ONLY the SPT policy statement(s). Each statement must end with a semicolon.
-Output format: Just the SPT statement(s), no explanations or JSON."""
+@functools.lru_cache(maxsize=512)
+def _policy_prompt_from_json(checklist_json: bytes) -> str:
+    """Generate the policy prompt for an already serialized checklist"""
+    return _POLICY_PROMPT_HEAD + checklist_json.decode()
 
-    def generate_checklist(self, nl_requirement: str) -> Dict:
-        """Convert NL requirement to checklist using LLM"""
-        response = self.client.responses.create(
-            model="o4-mini",
-            input=self.nl_to_checklist_prompt(nl_requirement),
-            reasoning={
-                "effort": "high"
-            }
+def checklist_to_policy_prompt(checklist: Dict) -> str:
+    """Generate prompt for converting checklist to SPT policy"""
+    # Dicts aren't hashable, so the prompt is cached on the checklist's compact
+    # JSON (which is also what the prompt embeds, since indentation only adds tokens)
+    return _policy_prompt_from_json(orjson.dumps(checklist))
+
+# Generic feedback used to build the pre-clarified variant raced by speculative retries
+_SPECULATIVE_FEEDBACK: Final[str] = """The effect, principal, actions, resources or conditions may be missing or ambiguous."""
+
+# Matches duration components such as "1s", "6m0s" or "20ms" in x-ratelimit-reset-* headers
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_reset_seconds(value: str) -> float:
+    """Convert an OpenAI rate limit reset duration (e.g. "6m0s") to seconds"""
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_RE.findall(value))
+
+class _AdaptiveLimiter:
+    """AIMD concurrency limit for in-flight LLM requests"""
+    
+    def __init__(self, initial: int = 32, minimum: int = 1, maximum: int = 100, low_watermark: int = 5, cooldown: float = 5.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.low_watermark = low_watermark
+        self.cooldown = cooldown
+        self._in_flight = 0
+        self._successes = 0
+        self._hold_until = 0.0
+        self._cond = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+    
+    def decrease(self, hold: float = 0.0):
+        """Halve the limit once per rate limit event
+        
+        Requests already in flight report the same pressure, so further calls
+        within the cooldown (or hold, if longer) of the last decrease are ignored.
+        """
+        now = time.monotonic()
+        if now < self._hold_until:
+            return
+        self._hold_until = now + max(self.cooldown, hold)
+        self.limit = max(self.minimum, self.limit // 2)
+        self._successes = 0
+    
+    async def observe(self, headers):
+        """Adjust the limit from x-ratelimit-* response headers"""
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is not None and int(remaining) < self.low_watermark:
+            # Nearly out of request budget: back off and hold this slot until the window resets
+            reset_seconds = _parse_reset_seconds(headers.get("x-ratelimit-reset-requests", "1s"))
+            self.decrease(hold=reset_seconds)
+            await asyncio.sleep(reset_seconds)
+            return
+        
+        # Additive increase: grow by one after a full window of successes
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+            async with self._cond:
+                self._cond.notify_all()
+
+@dataclass
+class ChecklistComponent:
+    """One effect/principal/actions/resources entry of a checklist requirement"""
+    confidence: str
+    nl_source: str = "Not specified"
+    ambiguity_reason: str = "Not specified"
+    resolution_required: List[str] = field(default_factory=list)
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ChecklistComponent":
+        return cls(
+            confidence=data['confidence'],
+            nl_source=data.get('nlSource', 'Not specified'),
+            ambiguity_reason=data.get('ambiguityReason', 'Not specified'),
+            resolution_required=data.get('resolutionRequired') or []
+        )
+
+@dataclass
+class ChecklistRequirement:
+    """A single rule of a checklist"""
+    effect: ChecklistComponent
+    principal: ChecklistComponent
+    actions: ChecklistComponent
+    resources: ChecklistComponent
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ChecklistRequirement":
+        return cls(
+            effect=ChecklistComponent.from_dict(data['effect']),
+            principal=ChecklistComponent.from_dict(data['principal']),
+            actions=ChecklistComponent.from_dict(data['actions']),
+            resources=ChecklistComponent.from_dict(data['resources'])
+        )
+
+@dataclass
+class Checklist:
+    """Typed view of the checklist fields used for status analysis"""
+    status: str
+    ambiguity_level: str
+    requirements: List[ChecklistRequirement]
+    missing_required: List[str]
+    ambiguous_elements: List[str]
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Checklist":
+        """Parse and validate a raw checklist dict; raises KeyError on missing fields"""
+        metadata = data['checklistMetadata']
+        guidance = data['resolutionGuidance']
+        return cls(
+            status=metadata['status'],
+            ambiguity_level=metadata['ambiguityLevel'],
+            requirements=[ChecklistRequirement.from_dict(req) for req in data['requirements']],
+            missing_required=guidance['missingRequired'],
+            ambiguous_elements=guidance['ambiguousElements']
+        )
+
+class PolicyRequirementsEngineer:
+    def __init__(self, api_key: str = None, cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+                 http_backend: Literal["httpx", "aiohttp"] = "httpx"):
+        # Load environment variables from .env file
+        load_dotenv()
+        
+        # Use provided api_key or get from environment variable
+        self.api_key = api_key or os.getenv('OPENAI_API_KEY')
+        if not self.api_key:
+            raise ValueError("OpenAI API key not found. Please set OPENAI_API_KEY environment variable or provide it as an argument.")
+        
+        # Share one pooled connection pool across every LLM call so the feedback
+        # loop and concurrent test cases reuse warm TLS connections
+        if http_backend == "aiohttp":
+            # Requires `pip install openai[aiohttp]`; lower per-request overhead
+            # raises the concurrency ceiling for large test runs
+            from openai import DefaultAioHttpClient
+            self._http = DefaultAioHttpClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS["aiohttp"],
+                    keepalive_expiry=KEEPALIVE_EXPIRY
+                ),
+                timeout=60.0
+            )
+        elif http_backend == "httpx":
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS["httpx"],
+                    max_keepalive_connections=20,
+                    keepalive_expiry=KEEPALIVE_EXPIRY
+                ),
+                http2=True,
+                timeout=60.0
+            )
+        else:
+            raise ValueError(f"Unknown HTTP backend: {http_backend!r}. Use 'httpx' or 'aiohttp'.")
+        self.client = AsyncOpenAI(
+            api_key=self.api_key,
+            http_client=self._http,
+            # 429s are retried by _request_text so the limiter sees them; the SDK must not retry underneath
+            max_retries=0
         )
+        self._warm_up_task: Optional[asyncio.Task] = None
+        
+        # Raw LLM responses are cached on disk by request hash; None disables caching
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir else None
         
-        # Extract text from response
+        # Gate concurrent requests so asyncio.gather over many cases doesn't trigger 429s
+        self._limiter = _AdaptiveLimiter(maximum=MAX_CONNECTIONS[http_backend])
+    
+    async def warm_up(self):
+        """Open a pooled connection to the API ahead of the first real request"""
+        try:
+            await self._http.get(
+                str(self.client.base_url.join("models")),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=5.0
+            )
+        except Exception:
+            # Warming is best effort; the first real request will connect if this failed
+            pass
+    
+    async def _keep_warm(self):
+        """Re-warm the pooled connection just before it would expire while idle"""
+        while True:
+            await self.warm_up()
+            await asyncio.sleep(KEEPALIVE_EXPIRY * 0.8)
+    
+    async def aclose(self):
+        """Close the pooled HTTP connections"""
+        if self._warm_up_task:
+            self._warm_up_task.cancel()
+        await self._http.aclose()
+    
+    async def __aenter__(self):
+        # Warm the connection in the background so TLS setup overlaps startup work
+        self._warm_up_task = asyncio.create_task(self.warm_up())
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+        
+    def _cache_path(self, prompt: str) -> Optional[Path]:
+        """Return the cache file for a prompt, keyed by SHA-256 of the full request"""
+        if self.cache_dir is None:
+            return None
+        request = {"model": MODEL, "input": prompt, "reasoning": REASONING}
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+        return self.cache_dir / f"{key}.txt"
+    
+    async def _request_text(self, prompt: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        """Send a prompt to the LLM and return the raw response text, using the disk cache
+        
+        The response is streamed; on_delta, if given, is called with each text
+        chunk as it arrives (or once with the full text on a cache hit).
+        """
+        cache_path = self._cache_path(prompt)
+        if cache_path and cache_path.exists():
+            raw_text = cache_path.read_text(encoding="utf-8")
+            if on_delta:
+                on_delta(raw_text)
+            return raw_text
+        
+        for attempt in range(MAX_RATE_LIMIT_RETRIES):
+            try:
+                async with self._limiter:
+                    raw_response = await self.client.responses.with_raw_response.create(
+                        model=MODEL,
+                        input=prompt,
+                        reasoning=REASONING,
+                        stream=True,
+                        extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+                    )
+                    chunks = []
+                    async for event in raw_response.parse():
+                        if event.type == "response.output_text.delta":
+                            chunks.append(event.delta)
+                            if on_delta:
+                                on_delta(event.delta)
+                        elif event.type in ("response.failed", "response.incomplete", "error"):
+                            print("Response event:", event)
+                            raise ValueError(f"Unable to extract text from response ({event.type})")
+                    await self._limiter.observe(raw_response.headers)
+                break
+            except RateLimitError:
+                self._limiter.decrease()
+                if attempt == MAX_RATE_LIMIT_RETRIES - 1:
+                    raise
+                # Exponential backoff with jitter, between 1 and 32 seconds
+                await asyncio.sleep(random.uniform(1, min(32, 2 ** (attempt + 1))))
+        
+        raw_text = "".join(chunks)
+        self._cache_store(cache_path, raw_text)
+        return raw_text
+    
+    def _cache_store(self, cache_path: Optional[Path], raw_text: str):
+        """Persist raw response text to the disk cache"""
+        if cache_path is None:
+            return
+        # Write to a temp file first so readers never see a partial entry
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(raw_text, encoding="utf-8")
+        tmp_path.replace(cache_path)
+    
+    def _cache_evict(self, prompt: str):
+        """Drop a cached response that turned out to be unusable"""
+        cache_path = self._cache_path(prompt)
+        if cache_path:
+            cache_path.unlink(missing_ok=True)
+    
+    @staticmethod
+    def _batch_output_text(body: Dict) -> str:
+        """Join the output_text parts of a raw /v1/responses body from a batch result"""
+        return "".join(
+            part["text"]
+            for item in body.get("output", [])
+            if item.get("type") == "message"
+            for part in item.get("content", [])
+            if part.get("type") == "output_text"
+        )
+    
+    async def _run_batch(self, prompts: Dict[str, str], poll_interval: float = 30.0) -> Dict[str, str]:
+        """Run prompts through the OpenAI Batch API, returning raw text by custom_id
+        
+        Cached prompts are answered from the disk cache and not submitted. Requests
+        that fail inside the batch, or that an expired or cancelled batch never
+        reached, are omitted from the returned mapping.
+        """
+        texts = {}
+        lines = []
+        for custom_id, prompt in prompts.items():
+            cache_path = self._cache_path(prompt)
+            if cache_path and cache_path.exists():
+                texts[custom_id] = cache_path.read_text(encoding="utf-8")
+                continue
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/responses",
+                "body": {
+                    "model": MODEL,
+                    "input": prompt,
+                    "reasoning": REASONING,
+                    "prompt_cache_key": PROMPT_CACHE_KEY
+                }
+            }))
+        
+        if not lines:
+            return texts
+        
+        batch_file = await self.client.files.create(
+            file=("policy_batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/responses",
+            completion_window="24h"
+        )
+        print(f"Submitted batch {batch.id} with {len(lines)} requests")
+        
+        while batch.status not in BATCH_TERMINAL_STATUSES:
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+            print(f"Batch {batch.id}: {batch.status}")
+        
+        if batch.status != "completed":
+            # Expired and cancelled batches still carry the results that finished in time
+            print(f"Batch {batch.id} finished with status {batch.status}; keeping any partial results")
+        if not batch.output_file_id:
+            return texts
+        
+        content = await self.client.files.content(batch.output_file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                print(f"Batch request {item['custom_id']} failed: {item.get('error') or response.get('body')}")
+                continue
+            raw_text = self._batch_output_text(response["body"])
+            self._cache_store(self._cache_path(prompts[item["custom_id"]]), raw_text)
+            texts[item["custom_id"]] = raw_text
+        
+        return texts
+        
+    def _clean_response_text(self, text: str) -> str:
+        """Remove markdown code block formatting from response text"""
+        text = text.strip()
+        
+        # Remove opening markdown code block ('```json' in any case, or bare '```')
+        if text[:7].lower() == '```json':
+            text = text[7:]
+        elif text.startswith('```'):
+            text = text[3:]
+        
+        # Remove closing markdown code block
+        return text.removesuffix('```').strip()
+        
+    def nl_to_checklist_prompt(self, nl_requirement: str) -> str:
+        """Generate prompt for converting NL to checklist DSL"""
+        return nl_to_checklist_prompt(nl_requirement)
+
+    def checklist_to_policy_prompt(self, checklist: Dict) -> str:
+        """Generate prompt for converting checklist to SPT policy"""
+        return checklist_to_policy_prompt(checklist)
+
+    async def generate_checklist(self, nl_requirement: str) -> Dict:
+        """Convert NL requirement to checklist using LLM"""
+        prompt = self.nl_to_checklist_prompt(nl_requirement)
+        return self._parse_checklist(await self._request_text(prompt), prompt)
+
+    def _parse_checklist(self, raw_text: str, prompt: str) -> Dict:
+        """Parse raw checklist response text into a dict"""
         try:
-            if hasattr(response, 'output_text'):
-                raw_text = response.output_text
-            elif hasattr(response, 'output') and response.output:
-                # Access via output array
-                raw_text = response.output[0].content[0].text
-            else:
-                print("Response object:", response)
-                raise ValueError("Unable to extract text from response")
-            
             # Clean the response text (remove markdown code blocks)
             cleaned_text = self._clean_response_text(raw_text)
             print("Cleaned JSON:", cleaned_text[:100] + "..." if len(cleaned_text) > 100 else cleaned_text)
             
-            return json.loads(cleaned_text)
+            return orjson.loads(cleaned_text)
         except Exception as e:
             print(f"Error parsing response: {e}")
-            print(f"Raw response: {response}")
+            print(f"Raw response: {raw_text}")
+            # Don't keep serving an unparseable response from the cache
+            self._cache_evict(prompt)
             raise
 
-    def generate_policy(self, checklist: Dict) -> str:
-        """Generate SPT policy from checklist using LLM"""
-        response = self.client.responses.create(
-            model="o4-mini",
-            input=self.checklist_to_policy_prompt(checklist),
-            reasoning={
-                "effort": "high"
-            }
-        )
+    async def generate_policy(self, checklist: Dict, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        """Generate SPT policy from checklist using LLM, optionally streaming raw text to on_delta"""
+        raw_text = await self._request_text(self.checklist_to_policy_prompt(checklist), on_delta)
         
-        # Extract and clean text from response
-        try:
-            if hasattr(response, 'output_text'):
-                raw_text = response.output_text
-            elif hasattr(response, 'output') and response.output:
-                raw_text = response.output[0].content[0].text
-            else:
-                raise ValueError("Unable to extract text from response")
-            
-            # Clean the response text (remove markdown code blocks if present)
-            cleaned_text = self._clean_response_text(raw_text)
-            return cleaned_text.strip()
-        except Exception as e:
-            print(f"Error parsing policy response: {e}")
-            print(f"Raw response: {response}")
-            raise
+        # Clean the response text (remove markdown code blocks if present)
+        return self._clean_response_text(raw_text)
 
     def analyze_requirement_status(self, checklist: Dict) -> Tuple[bool, str, List[str]]:
         """Analyze the checklist status and return feedback if needed"""
@@ -205,55 +560,120 @@ Output format: Just the SPT statement(s), no explanations or JSON."""
         if status == "COMPLETE" and ambiguity_level == "NONE":
             return True, "Requirement is complete and unambiguous.", []
         
+        # Only checklists that need feedback are parsed into the typed view
+        parsed = Checklist.from_dict(checklist)
+        
         feedback_messages = []
+        check_missing = status == "INCOMPLETE"
+        check_ambiguous = ambiguity_level != "NONE"
+        missing_messages = []
+        ambiguous_messages = []
+        
+        # Collect missing and ambiguous components in a single pass over the requirements
+        if check_missing or check_ambiguous:
+            for req in parsed.requirements:
+                # Effect is only ever reported as missing, never as ambiguous
+                if check_missing and req.effect.confidence == "MISSING":
+                    missing_messages.append(f"- Effect: {req.effect.nl_source}")
+                for label, component in (('Principal', req.principal), ('Actions', req.actions),
+                                         ('Resources', req.resources)):
+                    confidence = component.confidence
+                    if check_missing and confidence == "MISSING":
+                        missing_messages.append(f"- {label}: {component.nl_source}")
+                    elif check_ambiguous and confidence == "AMBIGUOUS":
+                        ambiguous_messages.append(f"- {label}: {component.ambiguity_reason}")
+                        if component.resolution_required:
+                            ambiguous_messages.append(f"  Suggestions: {', '.join(component.resolution_required)}")
         
         # Check for incomplete requirements
-        if status == "INCOMPLETE":
+        if check_missing:
             feedback_messages.append("The requirement is incomplete. Missing elements:")
-            for req in checklist['requirements']:
-                for component in ['effect', 'principal', 'actions', 'resources']:
-                    if req[component]['confidence'] == "MISSING":
-                        feedback_messages.append(f"- {component.capitalize()}: {req[component].get('nlSource', 'Not specified')}")
+            feedback_messages.extend(missing_messages)
         
         # Check for ambiguities
-        if ambiguity_level != "NONE":
+        if check_ambiguous:
             feedback_messages.append(f"\nThe requirement has {ambiguity_level.lower()} ambiguity:")
-            for req in checklist['requirements']:
-                for component in ['principal', 'actions', 'resources']:
-                    if req[component]['confidence'] == "AMBIGUOUS":
-                        feedback_messages.append(f"- {component.capitalize()}: {req[component]['ambiguityReason']}")
-                        if req[component].get('resolutionRequired'):
-                            feedback_messages.append(f"  Suggestions: {', '.join(req[component]['resolutionRequired'])}")
+            feedback_messages.extend(ambiguous_messages)
         
         # Add resolution guidance if available
-        if checklist['resolutionGuidance']['missingRequired'] or checklist['resolutionGuidance']['ambiguousElements']:
+        if parsed.missing_required or parsed.ambiguous_elements:
             feedback_messages.append("\nResolution guidance:")
-            if checklist['resolutionGuidance']['missingRequired']:
+            if parsed.missing_required:
                 feedback_messages.append("Missing elements that need to be specified:")
-                feedback_messages.extend([f"- {item}" for item in checklist['resolutionGuidance']['missingRequired']])
-            if checklist['resolutionGuidance']['ambiguousElements']:
+                feedback_messages.extend([f"- {item}" for item in parsed.missing_required])
+            if parsed.ambiguous_elements:
                 feedback_messages.append("Elements that need clarification:")
-                feedback_messages.extend([f"- {item}" for item in checklist['resolutionGuidance']['ambiguousElements']])
+                feedback_messages.extend([f"- {item}" for item in parsed.ambiguous_elements])
         
-        return False, "\n".join(feedback_messages), checklist['resolutionGuidance'].get('missingRequired', [])
+        return False, "\n".join(feedback_messages), parsed.missing_required
         
-    def process_requirement(self, nl_requirement: str, max_attempts: int = 3) -> Dict:
-        """Process a requirement with feedback loop for incomplete/ambiguous cases"""
+    def _clarification_request(self, current_requirement: str, feedback: str) -> str:
+        """Build the follow-up requirement that asks the LLM to address feedback"""
+        return f"""Original requirement: {current_requirement}
+
+Please provide additional information to address the following issues:
+{feedback}
+
+Please provide a complete and unambiguous requirement that addresses these points."""
+        
+    async def _checklist_with_status(self, requirement: str) -> Tuple[Dict, Tuple[bool, str, List[str]]]:
+        """Generate a checklist and analyze its status"""
+        checklist = await self.generate_checklist(requirement)
+        try:
+            return checklist, self.analyze_requirement_status(checklist)
+        except (KeyError, TypeError, ValueError):
+            # Valid JSON of the wrong shape must not be served from the cache either
+            self._cache_evict(self.nl_to_checklist_prompt(requirement))
+            raise
+
+    async def _first_complete_checklist(self, requirements: List[str]) -> Tuple[Dict, Tuple[bool, str, List[str]]]:
+        """Race checklist generation for several phrasings of a requirement
+        
+        Returns the first result that is complete, cancelling the others. If none
+        is complete, returns the result for the first phrasing (re-raising its
+        error if it failed); failures of the other phrasings are ignored.
+        """
+        tasks = [asyncio.create_task(self._checklist_with_status(req)) for req in requirements]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    checklist, analysis = await next_done
+                except Exception:
+                    continue
+                if analysis[0]:
+                    return checklist, analysis
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+    async def process_requirement(self, nl_requirement: str, max_attempts: int = 3,
+                                  on_policy_delta: Optional[Callable[[str], None]] = None,
+                                  speculative: bool = False) -> Dict:
+        """Process a requirement with feedback loop for incomplete/ambiguous cases
+        
+        With speculative=True, each attempt but the last also races a pre-clarified
+        variant of the requirement and keeps whichever checklist is complete first,
+        trading extra LLM calls for fewer sequential feedback rounds.
+        """
         attempts = 0
         current_requirement = nl_requirement
         
         while attempts < max_attempts:
-            # Generate checklist
-            checklist = self.generate_checklist(current_requirement)
-            
-            # Analyze status
-            is_complete, feedback, missing_elements = self.analyze_requirement_status(checklist)
+            # Generate checklist and analyze status
+            if speculative and attempts < max_attempts - 1:
+                checklist, (is_complete, feedback, missing_elements) = await self._first_complete_checklist([
+                    current_requirement,
+                    self._clarification_request(current_requirement, _SPECULATIVE_FEEDBACK)
+                ])
+            else:
+                checklist, (is_complete, feedback, missing_elements) = await self._checklist_with_status(current_requirement)
             
             if is_complete:
                 return {
                     "status": "success",
                     "checklist": checklist,
-                    "policy": self.generate_policy(checklist),
+                    "policy": await self.generate_policy(checklist, on_policy_delta),
                     "attempts": attempts + 1
                 }
             
@@ -268,12 +688,7 @@ Output format: Just the SPT statement(s), no explanations or JSON."""
                 }
             
             # Update requirement based on feedback
-            current_requirement = f"""Original requirement: {current_requirement}
-
-Please provide additional information to address the following issues:
-{feedback}
-
-Please provide a complete and unambiguous requirement that addresses these points."""
+            current_requirement = self._clarification_request(current_requirement, feedback)
             
             attempts += 1
         
@@ -285,32 +700,142 @@ Please provide a complete and unambiguous requirement that addresses these point
             "attempts": attempts
         }
 
-    def run_mvp_test(self, test_cases: List[str], output_file: str = "policy_test_results.json"):
-        """Run the MVP test and save results to JSON file"""
-        all_results = []
+    async def _run_test_case(self, index: int, nl_req: str) -> Dict:
+        """Process a single test case and report its outcome"""
+        print(f"\nProcessing [{index}]: {nl_req[:60]}...")
+        try:
+            result = await self.process_requirement(nl_req)
+        except Exception as e:
+            # Keep one failed case from discarding the others; recorded like a batch error
+            result = {
+                "status": "error",
+                "feedback": f"Processing failed: {e!r}",
+                "missing_elements": [],
+                "attempts": 0
+            }
+        
+        # Each report is printed without awaiting in between, so lines from
+        # concurrently running cases never interleave
+        if result["status"] == "success":
+            print(f"\n[{index}] ✓ Successfully generated policy after {result['attempts']} attempts")
+        else:
+            print(f"\n[{index}] ✗ Requirement needs clarification:")
+            print(result["feedback"])
+        
+        return result
+
+    async def run_mvp_test(self, test_cases: List[str], output_file: str = "policy_test_results.json"):
+        """Run the MVP test concurrently and save results to JSON file"""
+        # Each case runs its own checklist -> policy pipeline, so a case's policy
+        # request goes out as soon as its checklist is complete instead of waiting
+        # for a separate policy wave behind the slowest checklist
+        # Identical requirements are processed once (labelled by their first
+        # position) and their result is reused for every repeat
+        unique_cases: Dict[str, int] = {}
+        for i, nl_req in enumerate(test_cases, 1):
+            unique_cases.setdefault(nl_req, i)
         
-        for nl_req in test_cases:
-            print(f"\nProcessing: {nl_req[:60]}...")
-            result = self.process_requirement(nl_req)
-            
-            if result["status"] == "success":
-                print(f"✓ Successfully generated policy after {result['attempts']} attempts")
-            else:
-                print(f"✗ Requirement needs clarification:")
-                print(result["feedback"])
+        unique_results = await asyncio.gather(
+            *(self._run_test_case(i, nl_req) for nl_req, i in unique_cases.items())
+        )
+        results_by_case = dict(zip(unique_cases, unique_results))
+        all_results = [results_by_case[nl_req] for nl_req in test_cases]
+        
+        self._save_test_results(test_cases, all_results, output_file)
+
+    async def run_mvp_test_batch(self, test_cases: List[str], output_file: str = "policy_test_results.json",
+                                 max_attempts: int = 3, poll_interval: float = 30.0):
+        """Run the MVP test through the OpenAI Batch API and save results to JSON file
+        
+        Intended for offline evaluation: each feedback-loop round submits every
+        pending checklist as one batch, then all policies go out as a final batch.
+        Batches are billed at a discount and do not count against request rate limits.
+        """
+        results: Dict[int, Dict] = {}
+        complete: Dict[int, Tuple[Dict, int]] = {}
+        # Submit each distinct requirement once; repeats share its result
+        unique_cases = list(dict.fromkeys(test_cases))
+        current = dict(enumerate(unique_cases))
+        
+        for attempt in range(1, max_attempts + 1):
+            if not current:
+                break
+            prompts = {f"checklist_{i}": self.nl_to_checklist_prompt(req) for i, req in current.items()}
+            texts = await self._run_batch(prompts, poll_interval)
             
-            all_results.append(result)
+            pending = {}
+            for i, requirement in current.items():
+                custom_id = f"checklist_{i}"
+                try:
+                    checklist = self._parse_checklist(texts[custom_id], prompts[custom_id])
+                    is_complete, feedback, missing_elements = self.analyze_requirement_status(checklist)
+                except (KeyError, TypeError, ValueError) as e:
+                    # A missing, unparseable or wrongly shaped checklist fails only this case
+                    self._cache_evict(prompts[custom_id])
+                    results[i] = {
+                        "status": "error",
+                        "feedback": f"Checklist generation failed: {e!r}",
+                        "missing_elements": [],
+                        "attempts": attempt
+                    }
+                    continue
+                
+                if is_complete:
+                    complete[i] = (checklist, attempt)
+                elif attempt == max_attempts:
+                    results[i] = {
+                        "status": "incomplete",
+                        "checklist": checklist,
+                        "feedback": feedback,
+                        "missing_elements": missing_elements,
+                        "attempts": attempt
+                    }
+                else:
+                    pending[i] = self._clarification_request(requirement, feedback)
+            current = pending
         
+        if complete:
+            prompts = {f"policy_{i}": self.checklist_to_policy_prompt(checklist) for i, (checklist, _) in complete.items()}
+            texts = await self._run_batch(prompts, poll_interval)
+            for i, (checklist, attempts) in complete.items():
+                if f"policy_{i}" not in texts:
+                    results[i] = {
+                        "status": "error",
+                        "checklist": checklist,
+                        "feedback": "Policy generation failed in batch",
+                        "missing_elements": [],
+                        "attempts": attempts
+                    }
+                    continue
+                results[i] = {
+                    "status": "success",
+                    "checklist": checklist,
+                    "policy": self._clean_response_text(texts[f"policy_{i}"]),
+                    "attempts": attempts
+                }
+        
+        results_by_case = {nl_req: results[i] for i, nl_req in enumerate(unique_cases)}
+        all_results = [results_by_case[nl_req] for nl_req in test_cases]
+        self._save_test_results(test_cases, all_results, output_file)
+
+    def _write_json(self, path: str, payload: Dict):
+        """Write payload as indented JSON in a single write, then fsync"""
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _save_test_results(self, test_cases: List[str], all_results: List[Dict], output_file: str):
+        """Save test results to JSON file and print a summary"""
         # Save to JSON file
-        with open(output_file, 'w') as f:
-            json.dump({
-                "test_run": {
-                    "timestamp": datetime.now().isoformat(),
-                    "total_test_cases": len(test_cases),
-                    "policies_per_case": 10
-                },
-                "results": all_results
-            }, f, indent=2)
+        self._write_json(output_file, {
+            "test_run": {
+                "timestamp": datetime.now(),
+                "total_test_cases": len(test_cases),
+                "policies_per_case": 10
+            },
+            "results": all_results
+        })
         
         print(f"\nResults saved to {output_file}")
         print("\nSummary:")
@@ -321,7 +846,7 @@ Please provide a complete and unambiguous requirement that addresses these point
             if result["status"] != "success":
                 print(f"  Issues: {len(result['missing_elements'])} missing elements")
 
-    def interactive_mode(self):
+    async def interactive_mode(self):
         """Interactive mode for users to input their own requirements"""
         print("\n" + "="*60)
         print("🔐 Policy Requirements Engineer - Interactive Mode")
@@ -330,59 +855,82 @@ Please provide a complete and unambiguous requirement that addresses these point
         print("Type 'quit' or 'exit' to stop, 'help' for examples.")
         print("-"*60)
         
-        while True:
-            try:
-                # Get user input
-                print("\n💬 Enter your policy requirement:")
-                user_input = input("> ").strip()
-                
-                # Handle special commands
-                if user_input.lower() in ['quit', 'exit', 'q']:
-                    print("\n👋 Goodbye!")
-                    break
-                elif user_input.lower() == 'help':
-                    self.show_examples()
-                    continue
-                elif not user_input:
-                    print("❌ Please enter a requirement or type 'help' for examples.")
-                    continue
-                
-                # Process the requirement
-                print(f"\n🔄 Processing: {user_input}")
-                print("-" * 50)
-                
-                result = self.process_requirement(user_input)
-                
-                # Display results
-                if result["status"] == "success":
-                    print(f"✅ Successfully generated policy after {result['attempts']} attempt(s)!")
-                    print("\n📋 Generated SPT Policy:")
-                    print("-" * 30)
-                    print(result["policy"])
-                    print("-" * 30)
-                else:
-                    print(f"❌ Requirement needs clarification (attempted {result['attempts']} times):")
-                    print("\n📝 Feedback:")
-                    print(result["feedback"])
+        # Prompt asynchronously so background tasks (connection warming) keep
+        # running while the user types
+        session = PromptSession()
+        keep_warm_task = asyncio.create_task(self._keep_warm())
+        try:
+            while True:
+                try:
+                    # Get user input
+                    print("\n💬 Enter your policy requirement:")
+                    user_input = (await session.prompt_async("> ")).strip()
                     
-                    if result.get("missing_elements"):
-                        print(f"\n🔍 Missing {len(result['missing_elements'])} key elements")
-                
-                # Ask if user wants to save result
-                save_choice = input("\n💾 Save this result to file? (y/n): ").strip().lower()
-                if save_choice in ['y', 'yes']:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"policy_result_{timestamp}.json"
-                    with open(filename, 'w') as f:
-                        json.dump(result, f, indent=2)
-                    print(f"✅ Result saved to {filename}")
+                    # Handle special commands
+                    if user_input.lower() in ['quit', 'exit', 'q']:
+                        print("\n👋 Goodbye!")
+                        break
+                    elif user_input.lower() == 'help':
+                        self.show_examples()
+                        continue
+                    elif not user_input:
+                        print("❌ Please enter a requirement or type 'help' for examples.")
+                        continue
                     
-            except KeyboardInterrupt:
-                print("\n\n👋 Goodbye!")
-                break
-            except Exception as e:
-                print(f"\n❌ Error: {e}")
-                print("Please try again or type 'help' for examples.")
+                    # Process the requirement
+                    print(f"\n🔄 Processing: {user_input}")
+                    print("-" * 50)
+                    
+                    streamed = []
+                    
+                    def show_policy_delta(delta: str):
+                        # Print the policy as it streams in, under a header on the first chunk
+                        if not streamed:
+                            print("\n📋 Generated SPT Policy:")
+                            print("-" * 30)
+                        streamed.append(delta)
+                        print(delta, end="", flush=True)
+                    
+                    # Interactive users are waiting on the answer, so race speculative retries
+                    result = await self.process_requirement(user_input, on_policy_delta=show_policy_delta, speculative=True)
+                    
+                    # Display results
+                    if result["status"] == "success":
+                        streamed_text = "".join(streamed)
+                        if streamed_text:
+                            print()
+                            print("-" * 30)
+                        # The stream shows the raw reply; repeat the cleaned policy if fences were stripped
+                        if result["policy"] != streamed_text.strip():
+                            print("\n📋 Cleaned SPT Policy:" if streamed_text else "\n📋 Generated SPT Policy:")
+                            print("-" * 30)
+                            print(result["policy"])
+                            print("-" * 30)
+                        print(f"✅ Successfully generated policy after {result['attempts']} attempt(s)!")
+                    else:
+                        print(f"❌ Requirement needs clarification (attempted {result['attempts']} times):")
+                        print("\n📝 Feedback:")
+                        print(result["feedback"])
+                        
+                        if result.get("missing_elements"):
+                            print(f"\n🔍 Missing {len(result['missing_elements'])} key elements")
+                    
+                    # Ask if user wants to save result
+                    save_choice = (await session.prompt_async("\n💾 Save this result to file? (y/n): ")).strip().lower()
+                    if save_choice in ['y', 'yes']:
+                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                        filename = f"policy_result_{timestamp}.json"
+                        self._write_json(filename, result)
+                        print(f"✅ Result saved to {filename}")
+                        
+                except (KeyboardInterrupt, EOFError):
+                    print("\n\n👋 Goodbye!")
+                    break
+                except Exception as e:
+                    print(f"\n❌ Error: {e}")
+                    print("Please try again or type 'help' for examples.")
+        finally:
+            keep_warm_task.cancel()
     
     def show_examples(self):
         """Show example policy requirements"""
@@ -404,22 +952,34 @@ Please provide a complete and unambiguous requirement that addresses these point
 if __name__ == "__main__":
     # Initialize the engineer
     engineer = PolicyRequirementsEngineer()
-    ß
+    
     # Check if user wants interactive mode
     print("Policy Requirements Engineer")
     print("1. Run predefined test cases")
     print("2. Interactive mode - enter your own requirements")
+    print("3. Run predefined test cases via the Batch API (offline, lower cost)")
     
-    choice = input("\nSelect mode (1 or 2): ").strip()
+    choice = input("\nSelect mode (1, 2 or 3): ").strip()
     
-    if choice == "2":
-        engineer.interactive_mode()
-    else:
-        # Test cases
-        test_cases = [
-            # AWS Documentation Example - should be considered complete
-            "Allow the IAM role 'JohnDoe' in account 111122223333 to get objects and object versions from the S3 bucket 'amzn-s3-demo-bucket' only for objects tagged with environment=production"
-        ]
-        
-        # Run tests
-        engineer.run_mvp_test(test_cases, "policy_test_results.json")
\ No newline at end of file
+    # Test cases
+    test_cases = [
+        # AWS Documentation Example - should be considered complete
+        "Allow the IAM role 'JohnDoe' in account 111122223333 to get objects and object versions from the S3 bucket 'amzn-s3-demo-bucket' only for objects tagged with environment=production"
+    ]
+    
+    async def main():
+        async with engineer:
+            if choice == "2":
+                await engineer.interactive_mode()
+            elif choice == "3":
+                await engineer.run_mvp_test_batch(test_cases, "policy_test_results.json")
+            else:
+                # Run tests
+                await engineer.run_mvp_test(test_cases, "policy_test_results.json")
+    
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # Ctrl+C while a request is in flight cancels main() instead of raising
+        # inside interactive_mode's loop, so say goodbye here
+        print("\n\n👋 Goodbye!")